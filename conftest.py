@@ -0,0 +1 @@
+# Puts the repository root on sys.path so the tests can import model_training under plain pytest
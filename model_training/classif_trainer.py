@@ -2,15 +2,20 @@ from settings import *
 from sklearn.feature_selection import SelectPercentile, mutual_info_classif
 from sklearn.pipeline import Pipeline, make_union
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.neural_network import MLPClassifier
-from sklearn.model_selection import StratifiedKFold, GridSearchCV, train_test_split
+from sklearn.preprocessing import FunctionTransformer
+from sklearn.model_selection import train_test_split
 from model_training.ordinal_rf import OrdinalRandomForestClassifier
-from model_training.helpers import preprocess_data, calculate_scores, generate_plots, print_debug
+from model_training.xgb_engine import fit_xgb_classifier
+from model_training.mlp_engine import FastMLPClassifier, mlp_params, to_float32, mlp_fit_report, print_mlp_summary
+from model_training.helpers import preprocess_data, calculate_scores, generate_plots, print_debug, fit_pipeline, \
+    collect_subject_folds, pool_fold_data, split_pooled_data, encode_subjects, subject_fingerprint, \
+    pooled_fingerprint, get_cache_filename, load_cache, save_cache, subset_probs, passthrough_subjects, RESULT_COLUMNS
 from sklearn.experimental import enable_iterative_imputer
 from sklearn.impute import IterativeImputer, MissingIndicator
 from sklearn.neighbors import KNeighborsRegressor
 import mord
 import xgboost as xgb
+import time
 import scipy.stats
 
 import warnings
@@ -23,14 +28,11 @@ def train_user_classification(data, id_table, label_name, model_type, run_id):
     print('Model:', model_type, ', Label:', label_name)
     image_filename = os.path.join(HOME_DIRECTORY, 'output', run_id, '%s_%s.png' % (model_type, label_name))
     csv_filename = os.path.join(HOME_DIRECTORY, 'output', run_id, '%s_%s.csv' % (model_type, label_name))
-    if os.path.exists(image_filename):
-        return
-
-    results = pd.DataFrame(columns=['subject_id', 'split_id', 'n_total', 'n_train', 'n_test', 'auc',
-                                    'mse', 'vse', 'null_mse', 'null_vse',
-                                    'mae', 'vae', 'null_mae', 'null_vae',
-                                    'macro_mse', 'macro_vse', 'null_macro_mse', 'null_macro_vse',
-                                    'macro_mae', 'macro_vae', 'null_macro_mae', 'null_macro_vae'])
+    if os.path.exists(image_filename) and not INCREMENTAL_RETRAIN:
+        return csv_filename, image_filename
+
+    start_time = time.time()
+    results = pd.DataFrame(columns=RESULT_COLUMNS)
     sorted_subjects = sorted(id_table.subject_id.unique())
     if DEBUG:
         sorted_subjects = sorted_subjects[:5]
@@ -43,123 +45,283 @@ def train_user_classification(data, id_table, label_name, model_type, run_id):
         if subj_id_table is None:
             continue
 
+        # Reuse stored fold results if none of the subject's inputs changed
+        if INCREMENTAL_RETRAIN:
+            fingerprint = subject_fingerprint(data, subj_id_table, folds, label_name, model_type)
+            cache_filename = get_cache_filename(run_id, model_type, label_name, subject)
+            cache = load_cache(cache_filename, fingerprint)
+            if cache is not None:
+                print('Subject: %s unchanged, reusing stored folds' % subject)
+                for result in cache['results']:
+                    results = results.append(result, ignore_index=True)
+                continue
+
         # Go through the folds
+        fold_results, fold_models = [], []
         for fold_idx, (id_table_train_idxs, id_table_test_idxs) in enumerate(folds):
             print('Subject: %s Fold: %d' % (subject, fold_idx))
 
-            # Separate train and test IDs
-            subj_id_table_train = subj_id_table.iloc[id_table_train_idxs, :]
-            subj_id_table_test = subj_id_table.iloc[id_table_test_idxs, :]
-            id_train = subj_id_table_train['ID'].values
-            id_test = subj_id_table_test['ID'].values
+            result, model = train_fold_classification(data, subj_id_table, subject, fold_idx, id_table_train_idxs,
+                                                      id_table_test_idxs, label_name, model_type)
+            if result is not None:
+                results = results.append(result, ignore_index=True)
+                fold_results.append(result)
+                fold_models.append(model)
+        if INCREMENTAL_RETRAIN:
+            save_cache(cache_filename, fingerprint, fold_results, fold_models)
 
-            # Grab corresponding data
-            subj_data_train = data[data['ID'].isin(id_train)]
-            subj_data_test = data[data['ID'].isin(id_test)]
+    # Save results
+    results.to_csv(csv_filename, index=False, encoding='utf-8')
 
-            # Add labels to the data
-            subj_data_train = pd.merge(subj_data_train, subj_id_table_train[['ID', label_name]], on='ID', how='left')
-            subj_data_test = pd.merge(subj_data_test, subj_id_table_test[['ID', label_name]], on='ID', how='left')
+    # Plot results
+    generate_plots(results, image_filename, model_type, label_name)
+    print_mlp_summary(results)
+    print('Elapsed time: %0.1fs' % (time.time() - start_time))
+    print('**********************')
+    return csv_filename, image_filename
 
-            # Separate into (train, validation, test) (features, labels)
-            x_train = subj_data_train.drop(['ID', label_name], axis=1).values
-            y_train = subj_data_train[label_name].values.astype(np.int)
-            x_test = subj_data_test.drop(['ID', label_name], axis=1).values
-            y_test = subj_data_test[label_name].values.astype(np.int)
-            x_train, x_valid, y_train, y_valid = \
-                train_test_split(x_train, y_train, test_size=FRAC_VALIDATION_DATA, stratify=y_train,
-                                 random_state=RANDOM_SEED)
-            train_classes, valid_classes, test_classes = np.unique(y_train), np.unique(y_valid), np.unique(y_test)
-            num_features = x_train.shape[1]
 
-            # Make sure that folds don't cut the data in a weird way
-            if len(train_classes) <= 1:
-                print_debug('Not enough classes in train')
-                continue
-            if len(test_classes) <= 1:
-                print_debug('Not enough classes in test')
-                continue
-            if any([c not in train_classes for c in test_classes]):
-                print_debug('There is a test class that is not in train')
-                continue
+def train_fold_classification(data, subj_id_table, subject, fold_idx, id_table_train_idxs, id_table_test_idxs,
+                              label_name, model_type):
+    # Separate train and test IDs
+    subj_id_table_train = subj_id_table.iloc[id_table_train_idxs, :]
+    subj_id_table_test = subj_id_table.iloc[id_table_test_idxs, :]
+    id_train = subj_id_table_train['ID'].values
+    id_test = subj_id_table_test['ID'].values
 
-            # Prepare data imputer for missing data
-            imputer = IterativeImputer(estimator=KNeighborsRegressor(n_neighbors=int(num_features/10)),
-                                       random_state=RANDOM_SEED)
+    # Grab corresponding data
+    subj_data_train = data[data['ID'].isin(id_train)]
+    subj_data_test = data[data['ID'].isin(id_test)]
+
+    # Add labels to the data
+    subj_data_train = pd.merge(subj_data_train, subj_id_table_train[['ID', label_name]], on='ID', how='left')
+    subj_data_test = pd.merge(subj_data_test, subj_id_table_test[['ID', label_name]], on='ID', how='left')
+
+    # Separate into (train, validation, test) (features, labels)
+    x_train = subj_data_train.drop(['ID', label_name], axis=1).values
+    y_train = subj_data_train[label_name].values.astype(np.int)
+    x_test = subj_data_test.drop(['ID', label_name], axis=1).values
+    y_test = subj_data_test[label_name].values.astype(np.int)
+    x_train, x_valid, y_train, y_valid = \
+        train_test_split(x_train, y_train, test_size=FRAC_VALIDATION_DATA, stratify=y_train,
+                         random_state=RANDOM_SEED)
+    train_classes, valid_classes, test_classes = np.unique(y_train), np.unique(y_valid), np.unique(y_test)
+    num_features = x_train.shape[1]
+
+    # Make sure that folds don't cut the data in a weird way
+    if len(train_classes) <= 1:
+        print_debug('Not enough classes in train')
+        return None, None
+    if len(test_classes) <= 1:
+        print_debug('Not enough classes in test')
+        return None, None
+    if any([c not in train_classes for c in test_classes]):
+        print_debug('There is a test class that is not in train')
+        return None, None
+
+    if model_type == CLASSIF_XGBOOST and XGBOOST_FAST_PATH:
+        # Fit natively on train data with early stopping on validation data
+        model = fit_xgb_classifier(x_train, y_train, x_valid, y_valid, train_classes)
+    else:
+        # Construct the pipeline
+        missing_train_class = any([k != train_classes[k] for k in range(len(train_classes))])
+        missing_valid_class = any([k != valid_classes[k] for k in range(len(valid_classes))])
+        pipeline, param_grid = make_classif_pipeline(model_type, num_features, train_classes, len(x_train))
+
+        # Remap classes to fill in gap if one exists
+        if model_type in (CLASSIF_ORDINAL_RANDOM_FOREST, CLASSIF_ORDINAL_LOGISTIC):
+            if missing_train_class:
+                print_debug('Forced to remap labels')
+                y_train = np.array(list(map(lambda x: np.where(train_classes == x), y_train))).flatten()
+            if missing_valid_class:
+                print_debug('Forced to remap labels')
+                y_valid = np.array(list(map(lambda x: np.where(valid_classes == x), y_valid))).flatten()
+
+        # Tune on validation data and fit the model on train data
+        model = fit_pipeline(pipeline, param_grid, x_train, y_train, x_valid, y_valid)
+
+    # Predict results on test data
+    preds = model.predict(x_test)
+    probs = model.predict_proba(x_test)
+
+    # Calculate scores and other subject information
+    scores = calculate_scores(y_train, y_test, train_classes, test_classes, subj_data_test, preds, probs)
+    result = {'subject_id': subject, 'split_id': fold_idx, 'n_total': len(id_table_train_idxs)+len(id_table_test_idxs),
+              'n_train': len(id_table_train_idxs), 'n_test': len(id_table_test_idxs),
+              **scores}
 
-            # Construct the automatic feature selection method
-            feature_selection = SelectPercentile(mutual_info_classif)
-            param_grid = {'featsel__percentile': np.arange(25, 101, 25)}
+    # Report epochs run and time saved by early stopping
+    if model_type == CLASSIF_MLP:
+        result = {**result, **mlp_fit_report(model)}
+    return result, model
 
-            # Construct the base model
+
+def train_pooled_classification(data, id_table, label_name, model_type, run_id):
+    print('Model:', model_type, ', Label:', label_name, ', Pooled')
+    image_filename = os.path.join(HOME_DIRECTORY, 'output', run_id, '%s_%s_pooled.png' % (model_type, label_name))
+    csv_filename = os.path.join(HOME_DIRECTORY, 'output', run_id, '%s_%s_pooled.csv' % (model_type, label_name))
+    if os.path.exists(image_filename) and not INCREMENTAL_RETRAIN:
+        return csv_filename, image_filename
+
+    start_time = time.time()
+    results = pd.DataFrame(columns=RESULT_COLUMNS)
+    subject_folds = collect_subject_folds(id_table, label_name)
+    subjects = list(subject_folds.keys())
+    num_folds = min([len(folds) for (_, folds) in subject_folds.values()], default=0)
+
+    # Reuse stored fold results if no subject's inputs changed
+    cache = None
+    if INCREMENTAL_RETRAIN:
+        fingerprint = pooled_fingerprint(data, subject_folds, label_name, model_type)
+        cache_filename = get_cache_filename(run_id, model_type, label_name, 'pooled')
+        cache = load_cache(cache_filename, fingerprint)
+        if cache is not None:
+            print('No subject changed, reusing stored folds')
+            for result in cache['results']:
+                results = results.append(result, ignore_index=True)
+            num_folds = 0
+    fold_results, fold_models = [], []
+
+    # Fit a single model per fold across all subjects
+    for fold_idx in range(num_folds):
+        print('Pooled fold: %d' % fold_idx)
+        pooled_data_train, subj_data_tests = pool_fold_data(data, label_name, subject_folds, fold_idx)
+
+        # Separate into (train, validation) (features, labels), adding subject identity as features
+        x_train, x_valid, y_train, y_valid, subj_y_trains = split_pooled_data(pooled_data_train, label_name, subjects)
+        train_classes, valid_classes = np.unique(y_train), np.unique(y_valid)
+        num_features = x_train.shape[1]
+        if len(train_classes) <= 1:
+            print_debug('Not enough classes in train')
+            continue
+
+        remapped = False
+        if model_type == CLASSIF_XGBOOST and XGBOOST_FAST_PATH:
+            # Fit natively on train data with early stopping on validation data
+            model = fit_xgb_classifier(x_train, y_train, x_valid, y_valid, train_classes)
+        else:
+            # Construct the pipeline
             missing_train_class = any([k != train_classes[k] for k in range(len(train_classes))])
             missing_valid_class = any([k != valid_classes[k] for k in range(len(valid_classes))])
-            if model_type == CLASSIF_RANDOM_FOREST:
-                base_model = RandomForestClassifier(random_state=RANDOM_SEED)
-                param_grid = {'model__n_estimators': np.arange(10, 51, 10), **param_grid}
-            elif model_type == CLASSIF_XGBOOST:
-                base_model = xgb.XGBClassifier(objective="multi:softprob", random_state=RANDOM_SEED)
-                base_model.set_params(**{'num_class': len(train_classes)})
-                param_grid = {'model__n_estimators': np.arange(25, 76, 10), **param_grid}
-            elif model_type == CLASSIF_ORDINAL_RANDOM_FOREST:
-                base_model = OrdinalRandomForestClassifier(random_state=RANDOM_SEED)
-                param_grid = {'model__n_estimators': np.arange(10, 51, 10), **param_grid}
-            elif model_type == CLASSIF_ORDINAL_LOGISTIC:
-                base_model = mord.LogisticSE()
-                param_grid = {'model__alpha': np.logspace(-1, 1, 3), **param_grid}
-            elif model_type == CLASSIF_MLP:
-                base_model = MLPClassifier(max_iter=1000, random_state=RANDOM_SEED)
-                half_x, quart_x = int(num_features/2), int(num_features/4)
-                param_grid = {'model__hidden_layer_sizes': [(half_x), (half_x, quart_x)], **param_grid}
-            else:
-                raise Exception('Not a valid model type')
-
-            # Create a pipeline
-            pipeline = Pipeline([
-                ('imputer', make_union(imputer, MissingIndicator())),
-                ('featsel', feature_selection),
-                ('model', base_model)
-            ])
+            pipeline, param_grid = make_classif_pipeline(model_type, num_features, train_classes, len(x_train),
+                                                         len(subjects))
 
             # Remap classes to fill in gap if one exists
             if model_type in (CLASSIF_ORDINAL_RANDOM_FOREST, CLASSIF_ORDINAL_LOGISTIC):
                 if missing_train_class:
                     print_debug('Forced to remap labels')
                     y_train = np.array(list(map(lambda x: np.where(train_classes == x), y_train))).flatten()
+                    remapped = True
                 if missing_valid_class:
                     print_debug('Forced to remap labels')
                     y_valid = np.array(list(map(lambda x: np.where(valid_classes == x), y_valid))).flatten()
 
-            # Identify ideal parameters using stratified k-fold cross-validation on validation data
-            cross_validator = StratifiedKFold(n_splits=PARAM_SEARCH_FOLDS, random_state=RANDOM_SEED)
-            grid_search = GridSearchCV(pipeline, param_grid=param_grid, cv=cross_validator)
-            grid_search.fit(x_valid, y_valid)
-            model = pipeline.set_params(**grid_search.best_params_)
-            print('Best params:', grid_search.best_params_)
+            # Tune on validation data and fit the model on train data
+            model = fit_pipeline(pipeline, param_grid, x_train, y_train, x_valid, y_valid)
+
+        # Report epochs run and time saved by early stopping, on each subject's result of the fold
+        fit_report = mlp_fit_report(model) if model_type == CLASSIF_MLP else {}
 
-            # Fit the model on train data
-            model.fit(x_train, y_train)
+        # Score each subject separately so results line up with the per-subject mode
+        for subject in subjects:
+            subj_id_table, folds = subject_folds[subject]
+            id_table_train_idxs, id_table_test_idxs = folds[fold_idx]
+            subj_data_test = subj_data_tests[subject]
+            subj_y_train = subj_y_trains[subject]
+            y_test = subj_data_test[label_name].values.astype(np.int)
+            subj_train_classes, test_classes = np.unique(subj_y_train), np.unique(y_test)
 
-            # Predict results on test data
+            # Make sure that folds don't cut the data in a weird way
+            if len(subj_train_classes) <= 1 or len(test_classes) <= 1:
+                print_debug('Not enough classes for subject %s' % subject)
+                continue
+            if any([c not in subj_train_classes for c in test_classes]):
+                print_debug('There is a test class that is not in train')
+                continue
+            if any([c not in train_classes for c in subj_train_classes]):
+                print_debug('There is a subject class that is not in pooled train')
+                continue
+
+            # Predict results on test data, keeping only the subject's classes
+            x_test = np.hstack([subj_data_test.drop(['ID', label_name], axis=1).values,
+                                encode_subjects(np.repeat(subject, len(subj_data_test)), subjects)])
             preds = model.predict(x_test)
-            probs = model.predict_proba(x_test)
+            if remapped:
+                preds = train_classes[preds]
+            probs = subset_probs(model.predict_proba(x_test), train_classes, subj_train_classes)
 
             # Calculate scores and other subject information
-            scores = calculate_scores(y_train, y_test, train_classes, test_classes, subj_data_test, preds, probs)
+            scores = calculate_scores(subj_y_train, y_test, subj_train_classes, test_classes, subj_data_test,
+                                      preds, probs)
             result = {'subject_id': subject, 'split_id': fold_idx, 'n_total': len(id_table_train_idxs)+len(id_table_test_idxs),
                       'n_train': len(id_table_train_idxs), 'n_test': len(id_table_test_idxs),
-                      **scores}
+                      **scores, **fit_report}
             results = results.append(result, ignore_index=True)
+            fold_results.append(result)
+        fold_models.append(model)
+    if INCREMENTAL_RETRAIN and cache is None:
+        save_cache(cache_filename, fingerprint, fold_results, fold_models)
 
     # Save results
     results.to_csv(csv_filename, index=False, encoding='utf-8')
 
     # Plot results
     generate_plots(results, image_filename, model_type, label_name)
+    print_mlp_summary(results, pooled=True)
+    print('Elapsed time: %0.1fs' % (time.time() - start_time))
     print('**********************')
     return csv_filename, image_filename
 
 
+def make_classif_pipeline(model_type, num_features, train_classes, num_samples, num_subjects=0):
+    # Prepare data imputer for missing data
+    imputer = IterativeImputer(estimator=KNeighborsRegressor(n_neighbors=int(num_features/10),
+                                                             n_jobs=THREADS_PER_WORKER),
+                               random_state=RANDOM_SEED)
+
+    # Construct the automatic feature selection method
+    feature_selection = SelectPercentile(mutual_info_classif)
+    param_grid = {'featsel__percentile': np.arange(25, 101, 25)}
+
+    # Construct the base model
+    if model_type == CLASSIF_RANDOM_FOREST:
+        base_model = RandomForestClassifier(n_jobs=THREADS_PER_WORKER, random_state=RANDOM_SEED)
+        param_grid = {'model__n_estimators': np.arange(10, 51, 10), **param_grid}
+    elif model_type == CLASSIF_XGBOOST:
+        base_model = xgb.XGBClassifier(objective="multi:softprob", n_jobs=THREADS_PER_WORKER,
+                                       random_state=RANDOM_SEED)
+        base_model.set_params(**{'num_class': len(train_classes)})
+        param_grid = {'model__n_estimators': XGBOOST_N_ESTIMATORS, **param_grid}
+    elif model_type == CLASSIF_ORDINAL_RANDOM_FOREST:
+        base_model = OrdinalRandomForestClassifier(random_state=RANDOM_SEED)
+        param_grid = {'model__n_estimators': np.arange(10, 51, 10), **param_grid}
+    elif model_type == CLASSIF_ORDINAL_LOGISTIC:
+        base_model = mord.LogisticSE()
+        param_grid = {'model__alpha': np.logspace(-1, 1, 3), **param_grid}
+    elif model_type == CLASSIF_MLP:
+        base_model = FastMLPClassifier(**mlp_params(num_samples))
+        half_x, quart_x = int(num_features/2), int(num_features/4)
+        param_grid = {'model__hidden_layer_sizes': [(half_x), (half_x, quart_x)], **param_grid}
+    else:
+        raise Exception('Not a valid model type')
+
+    # Create a pipeline
+    pipeline = Pipeline([
+        ('imputer', make_union(imputer, MissingIndicator())),
+        ('featsel', feature_selection),
+        ('model', base_model)
+    ])
+
+    # Keep the subject columns of pooled models out of the imputer and feature selector
+    if num_subjects:
+        pipeline, param_grid = passthrough_subjects(pipeline, param_grid, num_features, num_subjects)
+
+    # Train MLPs on float32 inputs in fast mode
+    if model_type == CLASSIF_MLP and MLP_FAST_MODE:
+        pipeline.steps.insert(len(pipeline.steps) - 1, ('float32', FunctionTransformer(to_float32)))
+    return pipeline, param_grid
+
+
 def compute_mean_ci(x):
     mean_x = np.mean(x)
     stderr_x = scipy.stats.sem(x)
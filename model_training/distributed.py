@@ -0,0 +1,176 @@
+from settings import *
+from model_training.task_queue import TaskQueue, TASK_DONE, TASK_FAILED, TASK_PENDING, TASK_RUNNING
+from model_training.classif_trainer import train_fold_classification
+from model_training.regress_trainer import train_fold_regression
+from model_training.helpers import collect_subject_folds, preprocess_data, generate_plots, subject_fingerprint, \
+    get_cache_filename, load_cache, save_cache, RESULT_COLUMNS
+import hashlib
+import socket
+import threading
+import traceback
+import time
+
+TASK_CLASSIFICATION, TASK_REGRESSION = 'classification', 'regression'
+
+
+def get_task_queue(run_id):
+    return TaskQueue(os.path.join(HOME_DIRECTORY, 'output', run_id, 'tasks.db'), TASK_LEASE_SECONDS, TASK_MAX_ATTEMPTS)
+
+
+def run_coordinator(data, id_table, label_names, run_id):
+    run_folder = os.path.join(HOME_DIRECTORY, 'output', run_id)
+
+    # Write the shared feature snapshot that tasks refer to, named by its contents so reruns on new data get their own
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    digest.update(pd.util.hash_pandas_object(id_table, index=False).values.tobytes())
+    snapshot_filename = os.path.join(run_folder, 'snapshot_%s.pkl' % digest.hexdigest()[:12])
+    if not os.path.exists(snapshot_filename):
+        output = open(snapshot_filename + '.tmp', 'wb')
+        pickle.dump((data, id_table), output)
+        output.close()
+        os.replace(snapshot_filename + '.tmp', snapshot_filename)
+
+    # Publish a task for every subject and fold of each (model, label) that needs training
+    combinations = [(TASK_CLASSIFICATION, model_type, label_name)
+                    for model_type in CLASSIFIERS for label_name in label_names]
+    combinations += [(TASK_REGRESSION, model_type, label_name)
+                     for model_type in REGRESSORS for label_name in label_names]
+    tasks, combination_subjects = [], {}
+    for (task_type, model_type, label_name) in combinations:
+        image_filename = os.path.join(run_folder, '%s_%s.png' % (model_type, label_name))
+        combination_subjects[(model_type, label_name)] = []
+        if os.path.exists(image_filename) and not INCREMENTAL_RETRAIN:
+            continue
+        for subject, (subj_id_table, folds) in collect_subject_folds(id_table, label_name).items():
+            # Task keys include the fingerprint so that changed subjects are trained again
+            fingerprint = subject_fingerprint(data, subj_id_table, folds, label_name, model_type)
+            keys = ['%s/%s/%s/%d/%s' % (model_type, label_name, subject, fold_idx, fingerprint)
+                    for fold_idx in range(len(folds))]
+            combination_subjects[(model_type, label_name)].append((subject, fingerprint, keys))
+            cache_filename = get_cache_filename(run_id, model_type, label_name, subject)
+            if INCREMENTAL_RETRAIN and load_cache(cache_filename, fingerprint) is not None:
+                continue
+            for fold_idx, key in enumerate(keys):
+                tasks.append((key, {'snapshot': snapshot_filename, 'task_type': task_type,
+                                    'model_type': model_type, 'label_name': label_name,
+                                    'subject': subject, 'fold_idx': fold_idx}))
+    queue = get_task_queue(run_id)
+    queue.publish(tasks)
+    print('Published %d tasks' % len(tasks))
+
+    # Wait for the workers to drain the queue, retrying tasks of lost workers
+    while True:
+        queue.requeue_expired()
+        counts = queue.counts()
+        print('Tasks: %d pending, %d running, %d done, %d failed' %
+              (counts[TASK_PENDING], counts[TASK_RUNNING], counts[TASK_DONE], counts[TASK_FAILED]))
+        if counts[TASK_PENDING] == 0 and counts[TASK_RUNNING] == 0:
+            break
+        time.sleep(TASK_POLL_SECONDS)
+    queue.mark_drained()
+
+    # Gather results for each (model, label) and save them as the local runs do
+    task_results = {key: (status, output, error) for (key, status, output, error) in queue.results()}
+    csv_files, img_files = [], []
+    for (task_type, model_type, label_name) in combinations:
+        image_filename = os.path.join(run_folder, '%s_%s.png' % (model_type, label_name))
+        csv_filename = os.path.join(run_folder, '%s_%s.csv' % (model_type, label_name))
+        csv_files.append(csv_filename)
+        img_files.append(image_filename)
+        if os.path.exists(image_filename) and not INCREMENTAL_RETRAIN:
+            continue
+
+        results = pd.DataFrame(columns=RESULT_COLUMNS)
+        for (subject, fingerprint, keys) in combination_subjects[(model_type, label_name)]:
+            cache_filename = get_cache_filename(run_id, model_type, label_name, subject)
+            cache = load_cache(cache_filename, fingerprint) if INCREMENTAL_RETRAIN else None
+            if cache is not None:
+                fold_results = cache['results']
+            else:
+                fold_results, fold_models, failed = [], [], False
+                for key in keys:
+                    status, output, error = task_results[key]
+                    if status == TASK_FAILED:
+                        print('Task %s failed:\n%s' % (key, error))
+                        failed = True
+                    elif output[0] is not None:
+                        fold_results.append(output[0])
+                        fold_models.append(output[1])
+                if INCREMENTAL_RETRAIN and not failed:
+                    save_cache(cache_filename, fingerprint, fold_results, fold_models)
+            for result in fold_results:
+                results = results.append(result, ignore_index=True)
+        results.to_csv(csv_filename, index=False, encoding='utf-8')
+        generate_plots(results, image_filename, model_type, label_name)
+    return csv_files, img_files
+
+
+def run_worker(run_id):
+    queue = get_task_queue(run_id)
+    worker_id = '%s-%d' % (socket.gethostname(), os.getpid())
+    snapshots = {}
+    print('Worker:', worker_id)
+
+    # Pull tasks until the coordinator marks a generation drained that this worker saw open or worked on, so that
+    # workers started before the coordinator publishes wait for the new tasks instead of exiting. Workers that
+    # only ever see drained generations give up after an idle period
+    open_generation, idle_since = None, time.time()
+    while True:
+        task_id, task = queue.claim(worker_id)
+        if task_id is None:
+            generation, drained = queue.generation()
+            if not drained:
+                open_generation = generation
+            elif open_generation is not None:
+                print('Generation %d drained' % generation)
+                break
+            elif time.time() - idle_since > TASK_IDLE_EXIT_SECONDS:
+                print('No tasks published for %ds' % TASK_IDLE_EXIT_SECONDS)
+                break
+            time.sleep(TASK_POLL_SECONDS)
+            continue
+
+        # The generation cannot be drained while this task is running, so it is the one the task belongs to
+        open_generation = queue.generation()[0]
+
+        # Keep the lease alive while the task trains
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=send_heartbeats, args=(queue, task_id, worker_id, stop_heartbeat))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            result = run_task(task, snapshots)
+            queue.complete(task_id, worker_id, result)
+        except Exception:
+            queue.fail(task_id, worker_id, traceback.format_exc())
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+        idle_since = time.time()
+
+
+def run_task(task, snapshots):
+    # Load the feature snapshot once per worker
+    if task['snapshot'] not in snapshots:
+        snapshots.clear()
+        snapshots[task['snapshot']] = pickle.load(open(task['snapshot'], 'rb'))
+    data, id_table = snapshots[task['snapshot']]
+
+    # Regenerate the subject's folds, which are deterministic given the snapshot
+    subject, fold_idx, label_name = task['subject'], task['fold_idx'], task['label_name']
+    subj_id_table, folds = preprocess_data(id_table, subject, label_name)
+    id_table_train_idxs, id_table_test_idxs = folds[fold_idx]
+    print('Model: %s Label: %s Subject: %s Fold: %d' % (task['model_type'], label_name, subject, fold_idx))
+
+    if task['task_type'] == TASK_CLASSIFICATION:
+        train_fold = train_fold_classification
+    else:
+        train_fold = train_fold_regression
+    return train_fold(data, subj_id_table, subject, fold_idx, id_table_train_idxs, id_table_test_idxs,
+                      label_name, task['model_type'])
+
+
+def send_heartbeats(queue, task_id, worker_id, stop_heartbeat):
+    while not stop_heartbeat.wait(TASK_HEARTBEAT_SECONDS):
+        queue.heartbeat(task_id, worker_id)
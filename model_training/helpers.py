@@ -1,9 +1,20 @@
 from settings import *
-from sklearn.model_selection import StratifiedKFold
+from sklearn.model_selection import StratifiedKFold, GridSearchCV, train_test_split
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
 from sklearn.metrics import roc_auc_score, mean_absolute_error, mean_squared_error
 from sklearn.preprocessing import label_binarize
 from scipy import stats
+from threadpoolctl import threadpool_limits
+from model_training.mlp_engine import warm_start_from
 import errno
+import hashlib
+
+RESULT_COLUMNS = ['subject_id', 'split_id', 'n_total', 'n_train', 'n_test', 'auc',
+                  'mse', 'vse', 'null_mse', 'null_vse',
+                  'mae', 'vae', 'null_mae', 'null_vae',
+                  'macro_mse', 'macro_vse', 'null_macro_mse', 'null_macro_vse',
+                  'macro_mae', 'macro_vae', 'null_macro_mae', 'null_macro_vae']
 
 
 def combine_data(watch_accel, watch_gyro, phone_accel):
@@ -20,6 +31,23 @@ def combine_data(watch_accel, watch_gyro, phone_accel):
     return data
 
 
+def aggregate_windows(data):
+    # Reduce each measurement's windows to summary statistics or a bounded sample of windows
+    if WINDOW_AGGREGATION == WINDOW_AGGREGATION_SUMMARY:
+        groups = data.groupby('ID', sort=False)
+        frames = [groups.mean().add_suffix('_mean'), groups.std().add_suffix('_std')]
+        for quantile in WINDOW_QUANTILES:
+            frames.append(groups.quantile(quantile).add_suffix('_q%d' % int(round(quantile * 100))))
+        data = pd.concat(frames, axis=1).reset_index()
+    elif WINDOW_AGGREGATION == WINDOW_AGGREGATION_SAMPLE:
+        data = data.sample(frac=1, random_state=RANDOM_SEED)
+        data = data.groupby('ID', sort=False).head(WINDOW_SAMPLE_SIZE).sort_index()
+
+    # Keep the ID as the last column
+    col_names = [col for col in data.columns if col != 'ID'] + ['ID']
+    return data[col_names]
+
+
 def preprocess_data(id_table, subject, label_name):
     # Get data belonging to a specific subject
     subj_id_table = id_table[id_table.subject_id == subject].copy()
@@ -56,6 +84,158 @@ def preprocess_data(id_table, subject, label_name):
     return subj_id_table, folds
 
 
+def collect_subject_folds(id_table, label_name):
+    # Filter each subject's data and generate folds, skipping subjects without enough data
+    sorted_subjects = sorted(id_table.subject_id.unique())
+    if DEBUG:
+        sorted_subjects = sorted_subjects[:5]
+
+    subject_folds = {}
+    for subject in sorted_subjects:
+        subj_id_table, folds = preprocess_data(id_table, subject, label_name)
+        if subj_id_table is not None:
+            subject_folds[subject] = (subj_id_table, folds)
+
+    return subject_folds
+
+
+def pool_fold_data(data, label_name, subject_folds, fold_idx):
+    # Gather every subject's train and test data for one fold, tagged with the subject
+    train_frames, test_frames = [], {}
+    for subject, (subj_id_table, folds) in subject_folds.items():
+        id_table_train_idxs, id_table_test_idxs = folds[fold_idx]
+        subj_id_table_train = subj_id_table.iloc[id_table_train_idxs, :]
+        subj_id_table_test = subj_id_table.iloc[id_table_test_idxs, :]
+
+        # Grab corresponding data and add labels to it
+        subj_data_train = data[data['ID'].isin(subj_id_table_train['ID'].values)]
+        subj_data_test = data[data['ID'].isin(subj_id_table_test['ID'].values)]
+        subj_data_train = pd.merge(subj_data_train, subj_id_table_train[['ID', label_name]], on='ID', how='left')
+        subj_data_test = pd.merge(subj_data_test, subj_id_table_test[['ID', label_name]], on='ID', how='left')
+
+        subj_data_train['subject_id'] = subject
+        train_frames.append(subj_data_train)
+        test_frames[subject] = subj_data_test
+
+    return pd.concat(train_frames, ignore_index=True), test_frames
+
+
+def split_pooled_data(pooled_data_train, label_name, subjects):
+    # Split each subject's rows as the per-subject mode does, so both modes score against the same train labels
+    x_trains, x_valids, y_trains, y_valids, subj_y_trains = [], [], [], [], {}
+    for subject in subjects:
+        subj_data_train = pooled_data_train[pooled_data_train['subject_id'] == subject]
+        x_train = np.hstack([subj_data_train.drop(['ID', 'subject_id', label_name], axis=1).values,
+                             encode_subjects(subj_data_train['subject_id'].values, subjects)])
+        y_train = subj_data_train[label_name].values.astype(np.int)
+        x_train, x_valid, y_train, y_valid = \
+            train_test_split(x_train, y_train, test_size=FRAC_VALIDATION_DATA, stratify=y_train,
+                             random_state=RANDOM_SEED)
+        x_trains.append(x_train)
+        x_valids.append(x_valid)
+        y_trains.append(y_train)
+        y_valids.append(y_valid)
+        subj_y_trains[subject] = y_train
+    return np.vstack(x_trains), np.vstack(x_valids), np.concatenate(y_trains), np.concatenate(y_valids), subj_y_trains
+
+
+def encode_subjects(subject_ids, subjects):
+    # One-hot encode subject identity so a pooled model can learn per-subject offsets
+    return (np.asarray(subject_ids)[:, None] == np.asarray(subjects)[None, :]).astype(np.float64)
+
+
+def passthrough_subjects(pipeline, param_grid, num_features, num_subjects):
+    # Route the trailing subject columns around the imputer and feature selector so they are always kept
+    sensor_steps = Pipeline(pipeline.steps[:-1])
+    columns = ColumnTransformer([('sensors', sensor_steps, slice(0, num_features - num_subjects))],
+                                remainder='passthrough')
+    pipeline = Pipeline([('features', columns), pipeline.steps[-1]])
+    param_grid = {key if key.startswith('model__') else 'features__sensors__' + key: values
+                  for (key, values) in param_grid.items()}
+    return pipeline, param_grid
+
+
+def subset_probs(probs, classes, subset):
+    # Keep the probability columns for a subset of classes and renormalize each row
+    probs = probs[:, np.searchsorted(classes, subset)]
+    totals = probs.sum(axis=1, keepdims=True)
+    uniform = np.full(probs.shape, 1 / len(subset))
+    return np.divide(probs, totals, out=uniform, where=totals > 0)
+
+
+def fit_pipeline(pipeline, param_grid, x_train, y_train, x_valid, y_valid):
+    # Identify ideal parameters using stratified k-fold cross-validation on validation data
+    cross_validator = StratifiedKFold(n_splits=PARAM_SEARCH_FOLDS, random_state=RANDOM_SEED)
+    grid_search = GridSearchCV(pipeline, param_grid=param_grid, cv=cross_validator)
+    grid_search.fit(x_valid, y_valid)
+    model = pipeline.set_params(**grid_search.best_params_)
+    print('Best params:', grid_search.best_params_)
+
+    # Start MLPs from the best network of the search, which was refit on this fold's validation split only
+    if MLP_WARM_START:
+        warm_start_from(model, grid_search.best_estimator_)
+
+    # Fit the model on train data
+    model.fit(x_train, y_train)
+    return model
+
+
+def model_config(model_type, label_name):
+    # Settings that change what a trained model looks like, so changing any of them forces a retrain
+    return {'model_type': model_type, 'label_name': label_name, 'random_seed': RANDOM_SEED,
+            'frac_validation_data': FRAC_VALIDATION_DATA, 'param_search_folds': PARAM_SEARCH_FOLDS,
+            'xgboost_fast_path': XGBOOST_FAST_PATH, 'xgboost_n_estimators': list(XGBOOST_N_ESTIMATORS),
+            'xgboost_early_stopping_rounds': XGBOOST_EARLY_STOPPING_ROUNDS,
+            'mlp_fast_mode': MLP_FAST_MODE, 'mlp_warm_start': 'validation' if MLP_WARM_START else False,
+            'mlp_max_iter': MLP_MAX_ITER, 'mlp_n_iter_no_change': MLP_N_ITER_NO_CHANGE,
+            'mlp_batches_per_epoch': MLP_BATCHES_PER_EPOCH}
+
+
+def subject_fingerprint(data, subj_id_table, folds, label_name, model_type):
+    # Hash the subject's feature rows, labels, split assignment and the model configuration
+    subj_data = data[data['ID'].isin(subj_id_table['ID'].values)]
+    digest = hashlib.sha1()
+    digest.update(repr(subj_data.columns.tolist()).encode())
+    digest.update(pd.util.hash_pandas_object(subj_data, index=False).values.tobytes())
+    digest.update(pd.util.hash_pandas_object(subj_id_table[['ID', label_name]], index=False).values.tobytes())
+    for (_, test_idxs) in folds:
+        digest.update(repr(subj_id_table['ID'].values[test_idxs].tolist()).encode())
+    digest.update(repr(sorted(model_config(model_type, label_name).items())).encode())
+    return digest.hexdigest()
+
+
+def pooled_fingerprint(data, subject_folds, label_name, model_type):
+    # A pooled model depends on every subject, so combine all of their fingerprints
+    digest = hashlib.sha1()
+    for subject, (subj_id_table, folds) in subject_folds.items():
+        digest.update(repr(subject).encode())
+        digest.update(subject_fingerprint(data, subj_id_table, folds, label_name, model_type).encode())
+    return digest.hexdigest()
+
+
+def get_cache_filename(run_id, model_type, label_name, name):
+    cache_folder = os.path.join(HOME_DIRECTORY, 'output', run_id, 'cache', '%s_%s' % (model_type, label_name))
+    make_dir(cache_folder)
+    return os.path.join(cache_folder, '%s.pkl' % name)
+
+
+def load_cache(filename, fingerprint):
+    # Stored fold results are only reused if they were trained on identical inputs
+    if not os.path.exists(filename):
+        return None
+    cache = pickle.load(open(filename, 'rb'))
+    if cache['fingerprint'] != fingerprint:
+        return None
+    return cache
+
+
+def save_cache(filename, fingerprint, fold_results, fold_models):
+    # Fold results and fitted models are stored together under the fingerprint they were trained for
+    output = open(filename, 'wb')
+    pickle.dump({'fingerprint': fingerprint, 'results': fold_results, 'models': fold_models}, output)
+    output.close()
+
+
 def calculate_scores(y_train, y_test, train_classes, test_classes, subj_data_test, preds, probs):
     # Bin probabilities over each diary entry
     y_test_bin, preds_bin, probs_bin = [], [], []
@@ -238,6 +418,12 @@ def compute_mean_ci(x):
     return mean_x, stderr_x
 
 
+def limit_threads():
+    # Pin thread pools of libraries loaded before the budget was applied to the environment
+    threadpool_limits(limits=THREADS_PER_WORKER)
+    print('Thread budget: %d = %d worker(s) x %d thread(s)' % (THREAD_BUDGET, NUM_WORKERS, THREADS_PER_WORKER))
+
+
 def print_debug(text):
     if DEBUG:
         print(text)
@@ -0,0 +1,99 @@
+from settings import *
+from sklearn.neural_network import MLPClassifier, MLPRegressor
+import copy
+import time
+
+
+# Adds fit timing and safe warm starts from another fit's network to the sklearn MLPs
+class FastMLPMixin:
+    def fit(self, x, y):
+        if self.warm_start and hasattr(self, 'coefs_'):
+            self._reset_warm_start(x, y)
+        start_time = time.time()
+        super().fit(x, y)
+        self.fit_time_ = time.time() - start_time
+        return self
+
+    def _reset_warm_start(self, x, y):
+        # Drop the carried-over network if its shape or targets changed, e.g. a different number of selected features
+        layer_units = [x.shape[1]] + list(np.atleast_1d(self.hidden_layer_sizes)) + [self.coefs_[-1].shape[1]]
+        coef_shapes = [coef.shape for coef in self.coefs_]
+        if coef_shapes != list(zip(layer_units[:-1], layer_units[1:])) or not self._same_targets(y):
+            for attribute in ['coefs_', 'classes_']:
+                if hasattr(self, attribute):
+                    delattr(self, attribute)
+            return
+
+        # Otherwise keep the weights but restart the epoch count and early stopping bookkeeping
+        self.n_iter_, self.t_ = 0, 0
+        self.loss_curve_ = []
+        self._no_improvement_count = 0
+        if self.early_stopping:
+            self.validation_scores_ = []
+            self.best_validation_score_ = -np.inf
+        else:
+            self.best_loss_ = np.inf
+
+
+class FastMLPClassifier(FastMLPMixin, MLPClassifier):
+    def fit(self, x, y):
+        # Stratified early stopping needs every class in both splits, so tiny fits stop on the training loss
+        early_stopping = self.early_stopping
+        counts = np.unique(y, return_counts=True)[1]
+        # sklearn rejects numpy booleans here, so the flag is cast back to a plain bool
+        self.early_stopping = bool(early_stopping and counts.min() >= 2 and
+                                   np.ceil(self.validation_fraction * len(y)) >= len(counts))
+        try:
+            return super().fit(x, y)
+        finally:
+            self.early_stopping = early_stopping
+
+    def _same_targets(self, y):
+        return np.array_equal(np.unique(y), self.classes_)
+
+
+class FastMLPRegressor(FastMLPMixin, MLPRegressor):
+    def _same_targets(self, y):
+        return True
+
+
+def mlp_params(num_samples):
+    params = {'max_iter': MLP_MAX_ITER, 'random_state': RANDOM_SEED}
+    if MLP_FAST_MODE:
+        # Stop on the validation score and size mini-batches to the subject's data
+        batch_size = int(np.clip(num_samples // MLP_BATCHES_PER_EPOCH, 16, 200))
+        params = {'early_stopping': True, 'n_iter_no_change': MLP_N_ITER_NO_CHANGE,
+                  'batch_size': batch_size, **params}
+    return params
+
+
+def to_float32(x):
+    return np.asarray(x, dtype=np.float32)
+
+
+def warm_start_from(pipeline, tuned_pipeline):
+    # Carry the tuned pipeline's network over to the final fit; other models are left as they are
+    if not isinstance(tuned_pipeline.named_steps['model'], FastMLPMixin):
+        return
+    mlp = copy.deepcopy(tuned_pipeline.named_steps['model'])
+    mlp.set_params(**pipeline.named_steps['model'].get_params())
+    mlp.set_params(warm_start=True)
+    pipeline.set_params(model=mlp)
+
+
+def mlp_fit_report(pipeline):
+    # Estimate the time saved against running the full fixed epoch budget
+    mlp = pipeline.named_steps['model']
+    time_saved = mlp.fit_time_ / mlp.n_iter_ * (MLP_MAX_ITER - mlp.n_iter_)
+    print('Epochs: %d/%d, fit time: %0.1fs, estimated time saved: %0.1fs' %
+          (mlp.n_iter_, MLP_MAX_ITER, mlp.fit_time_, time_saved))
+    return {'epochs': mlp.n_iter_, 'fit_time': mlp.fit_time_, 'time_saved': time_saved}
+
+
+def print_mlp_summary(results, pooled=False):
+    if 'epochs' in results.columns:
+        # Pooled results repeat each fold's single fit on every subject's row
+        if pooled:
+            results = results.drop_duplicates('split_id')
+        print('Total epochs: %d, fit time: %0.1fs, estimated time saved: %0.1fs' %
+              (results['epochs'].sum(), results['fit_time'].sum(), results['time_saved'].sum()))
@@ -0,0 +1,127 @@
+import pickle
+import sqlite3
+import time
+
+TASK_PENDING, TASK_RUNNING, TASK_DONE, TASK_FAILED = 'pending', 'running', 'done', 'failed'
+
+
+# SQLite-backed stand-in for a message broker, shared between hosts through the run folder
+class TaskQueue:
+    def __init__(self, path, lease_seconds, max_attempts):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        connection = self._connect()
+        connection.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                           'task_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'task_key TEXT UNIQUE, '
+                           'payload BLOB, '
+                           'status TEXT, '
+                           'worker TEXT, '
+                           'heartbeat REAL, '
+                           'attempts INTEGER DEFAULT 0, '
+                           'result BLOB, '
+                           'error TEXT)')
+
+        # Each publish opens a new generation, which the coordinator marks drained once it has gathered the results
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute('CREATE TABLE IF NOT EXISTS state (generation INTEGER, drained INTEGER)')
+        connection.execute('INSERT INTO state (generation, drained) SELECT 0, 1 '
+                           'WHERE NOT EXISTS (SELECT * FROM state)')
+        connection.execute('COMMIT')
+        connection.close()
+
+    def _connect(self):
+        # Autocommit mode so that transactions can be started explicitly
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def publish(self, tasks):
+        # Tasks already in the queue keep their state, so a restarted coordinator resumes where it stopped
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany('INSERT OR IGNORE INTO tasks (task_key, payload, status) VALUES (?, ?, ?)',
+                               [(key, pickle.dumps(payload), TASK_PENDING) for (key, payload) in tasks])
+
+        # Except failed tasks, which get a fresh set of attempts each time they are published
+        connection.executemany('UPDATE tasks SET status = ?, worker = NULL, heartbeat = NULL, attempts = 0 '
+                               'WHERE task_key = ? AND status = ?',
+                               [(TASK_PENDING, key, TASK_FAILED) for (key, _) in tasks])
+        connection.execute('UPDATE state SET generation = generation + 1, drained = 0')
+        connection.execute('COMMIT')
+        connection.close()
+
+    def claim(self, worker_id):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        self._requeue_expired(connection)
+        row = connection.execute('SELECT task_id, payload FROM tasks WHERE status = ? ORDER BY task_id LIMIT 1',
+                                 (TASK_PENDING,)).fetchone()
+        if row is not None:
+            connection.execute('UPDATE tasks SET status = ?, worker = ?, heartbeat = ?, attempts = attempts + 1 '
+                               'WHERE task_id = ?', (TASK_RUNNING, worker_id, time.time(), row[0]))
+        connection.execute('COMMIT')
+        connection.close()
+        if row is None:
+            return None, None
+        return row[0], pickle.loads(row[1])
+
+    def heartbeat(self, task_id, worker_id):
+        connection = self._connect()
+        connection.execute('UPDATE tasks SET heartbeat = ? WHERE task_id = ? AND worker = ? AND status = ?',
+                           (time.time(), task_id, worker_id, TASK_RUNNING))
+        connection.close()
+
+    def complete(self, task_id, worker_id, result):
+        # Only the worker currently holding the task may complete it
+        connection = self._connect()
+        connection.execute('UPDATE tasks SET status = ?, result = ?, error = NULL '
+                           'WHERE task_id = ? AND worker = ? AND status = ?',
+                           (TASK_DONE, pickle.dumps(result), task_id, worker_id, TASK_RUNNING))
+        connection.close()
+
+    def fail(self, task_id, worker_id, error):
+        connection = self._connect()
+        connection.execute('UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ? '
+                           'WHERE task_id = ? AND worker = ? AND status = ?',
+                           (self.max_attempts, TASK_PENDING, TASK_FAILED, error, task_id, worker_id, TASK_RUNNING))
+        connection.close()
+
+    def requeue_expired(self):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        self._requeue_expired(connection)
+        connection.execute('COMMIT')
+        connection.close()
+
+    def _requeue_expired(self, connection):
+        # Tasks whose worker stopped sending heartbeats are retried, up to the attempt limit
+        expiry = time.time() - self.lease_seconds
+        connection.execute('UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, '
+                           'error = \'Lease expired\' WHERE status = ? AND heartbeat < ?',
+                           (self.max_attempts, TASK_PENDING, TASK_FAILED, TASK_RUNNING, expiry))
+
+    def counts(self):
+        connection = self._connect()
+        rows = connection.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        connection.close()
+        counts = {TASK_PENDING: 0, TASK_RUNNING: 0, TASK_DONE: 0, TASK_FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def mark_drained(self):
+        connection = self._connect()
+        connection.execute('UPDATE state SET drained = 1')
+        connection.close()
+
+    def generation(self):
+        connection = self._connect()
+        generation, drained = connection.execute('SELECT generation, drained FROM state').fetchone()
+        connection.close()
+        return generation, bool(drained)
+
+    def results(self):
+        connection = self._connect()
+        rows = connection.execute('SELECT task_key, status, result, error FROM tasks').fetchall()
+        connection.close()
+        return [(key, status, pickle.loads(result) if result is not None else None, error)
+                for (key, status, result, error) in rows]
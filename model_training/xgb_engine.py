@@ -0,0 +1,74 @@
+from settings import *
+import inspect
+import xgboost as xgb
+
+# xgboost < 1.4 limits predictions by tree count rather than by a range of boosting rounds
+HAS_ITERATION_RANGE = 'iteration_range' in inspect.signature(xgb.Booster.predict).parameters
+
+
+# Booster trained natively with the hist method, exposing the predict interface of the sklearn pipelines
+class XGBoostModel:
+    def __init__(self, booster, n_estimators, classes=None):
+        self.booster = booster
+        self.n_estimators = n_estimators
+        self.classes = classes
+
+    def predict(self, x):
+        if self.classes is None:
+            return self._predict_raw(x)
+        return self.classes[np.argmax(self.predict_proba(x), axis=1)]
+
+    def predict_proba(self, x):
+        return self._predict_raw(x).reshape([len(x), -1])
+
+    def _predict_raw(self, x):
+        dmatrix = xgb.DMatrix(x, missing=np.nan, nthread=THREADS_PER_WORKER)
+        if HAS_ITERATION_RANGE:
+            return self.booster.predict(dmatrix, iteration_range=(0, self.n_estimators))
+        return self.booster.predict(dmatrix, ntree_limit=self.n_estimators)
+
+
+def fit_xgb_classifier(x_train, y_train, x_valid, y_valid, train_classes):
+    # Encode labels as class indices, dropping validation rows of classes that are not in train
+    in_train = np.isin(y_valid, train_classes)
+    params = {'objective': 'multi:softprob', 'num_class': len(train_classes), 'eval_metric': 'mlogloss'}
+    booster, n_estimators = fit_xgb(x_train, np.searchsorted(train_classes, y_train),
+                                    x_valid[in_train], np.searchsorted(train_classes, y_valid[in_train]), params)
+    return XGBoostModel(booster, n_estimators, train_classes)
+
+
+def fit_xgb_regressor(x_train, y_train, x_valid, y_valid):
+    params = {'objective': 'reg:squarederror', 'eval_metric': 'rmse'}
+    booster, n_estimators = fit_xgb(x_train, y_train, x_valid, y_valid, params)
+    return XGBoostModel(booster, n_estimators)
+
+
+def fit_xgb(x_train, y_train, x_valid, y_valid, params):
+    # Quantize the data once per fold; missing values are routed by the trees so no imputer is needed
+    dtrain = make_dmatrix(x_train, y_train)
+    dvalid = make_dmatrix(x_valid, y_valid, ref=dtrain)
+
+    # Train up to the largest grid point, stopping early once the validation loss stops improving
+    evals_result = {}
+    params = {'tree_method': 'hist', 'nthread': THREADS_PER_WORKER, 'seed': RANDOM_SEED, **params}
+    booster = xgb.train(params, dtrain, num_boost_round=int(np.max(XGBOOST_N_ESTIMATORS)), evals=[(dvalid, 'valid')],
+                        early_stopping_rounds=XGBOOST_EARLY_STOPPING_ROUNDS, evals_result=evals_result,
+                        verbose_eval=False)
+
+    # Pick the grid point with the lowest validation loss among the rounds that were trained, or the best
+    # round itself when early stopping ended before the smallest grid point
+    valid_loss = evals_result['valid'][params['eval_metric']]
+    candidates = [int(n) for n in XGBOOST_N_ESTIMATORS if n <= len(valid_loss)]
+    if candidates:
+        n_estimators = min(candidates, key=lambda n: valid_loss[n - 1])
+    else:
+        n_estimators = int(np.argmin(valid_loss)) + 1
+    print('Best params:', {'n_estimators': n_estimators})
+    return booster, n_estimators
+
+
+def make_dmatrix(x, y, ref=None):
+    # QuantileDMatrix (xgboost >= 1.7) builds the histogram bins directly, without keeping a copy of the raw data
+    if hasattr(xgb, 'QuantileDMatrix'):
+        return xgb.QuantileDMatrix(x, label=y, missing=np.nan, ref=ref, nthread=THREADS_PER_WORKER)
+    return xgb.DMatrix(x, label=y, missing=np.nan, nthread=THREADS_PER_WORKER)
@@ -1,9 +1,17 @@
 from settings import *
-from model_training.classif_trainer import train_user_classification
-from model_training.regress_trainer import train_user_regression
-from joblib import Parallel, delayed
+from model_training.classif_trainer import train_user_classification, train_pooled_classification
+from model_training.regress_trainer import train_user_regression, train_pooled_regression
+from joblib import Parallel, delayed, parallel_backend
 import itertools
-from model_training.helpers import make_dir, combine_data
+from model_training.helpers import make_dir, combine_data, limit_threads, aggregate_windows
+from model_training.distributed import run_coordinator
+
+# Distributed tasks are per subject and fold, so pooled models can only be trained locally
+if RUN_DISTRIBUTED and TRAIN_POOLED:
+    raise ValueError('TRAIN_POOLED is not supported with RUN_DISTRIBUTED')
+
+# Apply the thread budget to this process
+limit_threads()
 
 # Login to synapse
 syn = synapseclient.Synapse()
@@ -93,6 +101,12 @@ id_table = metadata[['ID', 'subject_id', 'dyskinesia', 'on_off', 'tremor']].drop
 metadata.set_index('ID', inplace=True)
 data = data[data['ID'].isin(metadata.index)]
 
+# Reduce windowed features before training so fit time does not scale with the windows per measurement
+if feature_source == FEATURE_SOURCE_PHIL and WINDOW_AGGREGATION != WINDOW_AGGREGATION_NONE:
+    num_rows = len(data)
+    data = aggregate_windows(data)
+    print('Aggregated windows: %d rows -> %d rows' % (num_rows, len(data)))
+
 # Encode split information
 if split_structure == SPLIT_STRUCTURE_DEFINED:
     meta_col_list = metadata.columns.tolist()
@@ -103,32 +117,39 @@ print('Done processing data')
 
 # Train model for each label
 label_names = ['on_off', 'dyskinesia', 'tremor']
+train_classification = train_pooled_classification if TRAIN_POOLED else train_user_classification
+train_regression = train_pooled_regression if TRAIN_POOLED else train_user_regression
 csv_files, img_files = [], []
-if not RUN_PARALLEL:
+if RUN_DISTRIBUTED:
+    # Publish subject/fold tasks and wait for workers started with worker.py
+    csv_files, img_files = run_coordinator(data, id_table, label_names, run_id)
+elif not RUN_PARALLEL:
     for model_type in CLASSIFIERS:
         for label_name in label_names:
-            csv_file, img_file = train_user_classification(data, id_table, label_name, model_type, run_id)
+            csv_file, img_file = train_classification(data, id_table, label_name, model_type, run_id)
             csv_files.append(csv_file)
             img_files.append(img_file)
     for model_type in REGRESSORS:
         for label_name in label_names:
-            csv_file, img_file = train_user_regression(data, id_table, label_name, model_type, run_id)
+            csv_file, img_file = train_regression(data, id_table, label_name, model_type, run_id)
             csv_files.append(csv_file)
             img_files.append(img_file)
 else:
-    combinations = list(itertools.product(CLASSIFIERS, label_names))
-    results = Parallel(n_jobs=NUM_THREADS)(delayed(train_user_classification)(data, id_table, label_name, model_type, run_id)
-                                           for (model_type, label_name) in combinations)
-    for i in range(len(combinations)):
-        csv_files.append(results[i][0])
-        img_files.append(results[i][1])
-
-    combinations = list(itertools.product(REGRESSORS, label_names))
-    results = Parallel(n_jobs=NUM_THREADS)(delayed(train_user_regression)(data, id_table, label_name, model_type, run_id)
-                                           for (model_type, label_name) in combinations)
-    for i in range(len(combinations)):
-        csv_files.append(results[i][0])
-        img_files.append(results[i][1])
+    # Cap the libraries inside each joblib worker at its share of the thread budget
+    with parallel_backend('loky', inner_max_num_threads=THREADS_PER_WORKER):
+        combinations = list(itertools.product(CLASSIFIERS, label_names))
+        results = Parallel(n_jobs=NUM_WORKERS)(delayed(train_classification)(data, id_table, label_name, model_type, run_id)
+                                                   for (model_type, label_name) in combinations)
+        for i in range(len(combinations)):
+            csv_files.append(results[i][0])
+            img_files.append(results[i][1])
+
+        combinations = list(itertools.product(REGRESSORS, label_names))
+        results = Parallel(n_jobs=NUM_WORKERS)(delayed(train_regression)(data, id_table, label_name, model_type, run_id)
+                                                   for (model_type, label_name) in combinations)
+        for i in range(len(combinations)):
+            csv_files.append(results[i][0])
+            img_files.append(results[i][1])
 
 # TODO: zip results
 
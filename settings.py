@@ -9,13 +9,36 @@ import synapseclient
 import pickle
 
 DEBUG = False
-NUM_THREADS = 2
+NUM_THREADS = 2  # Process-level workers when running in parallel
+THREAD_BUDGET = os.cpu_count()  # Total threads shared by the workers and the libraries inside them
 RANDOM_SEED = 812
 
 # Training parameters
 NUM_STRATIFIED_FOLDS = 10 if not DEBUG else 2
 FRAC_VALIDATION_DATA = 0.2
 PARAM_SEARCH_FOLDS = 3
+TRAIN_POOLED = False  # Fit one model per label and fold across all subjects instead of one per subject
+INCREMENTAL_RETRAIN = True  # Reuse stored fold results and models of subjects whose inputs did not change
+
+# Window aggregation for Phil-format features, which have many windowed rows per measurement
+WINDOW_AGGREGATION_NONE, WINDOW_AGGREGATION_SUMMARY, WINDOW_AGGREGATION_SAMPLE = 1, 2, 3
+WINDOW_AGGREGATION = WINDOW_AGGREGATION_NONE
+WINDOW_QUANTILES = [0.25, 0.5, 0.75]  # Summary statistics are mean, std and these quantiles
+WINDOW_SAMPLE_SIZE = 10  # Maximum windows kept per measurement when sampling
+
+# XGBoost parameters
+XGBOOST_FAST_PATH = True  # Train boosters natively on quantized data, skipping the imputer/selector pipeline
+XGBOOST_N_ESTIMATORS = np.arange(25, 76, 10)
+XGBOOST_EARLY_STOPPING_ROUNDS = 10
+
+# MLP parameters
+MLP_FAST_MODE = True  # Early stopping on a validation split, float32 inputs and mini-batches sized to the data
+# Start each fold's final fit from the network the parameter search refit on that fold's validation split.
+# Networks are never carried between folds: a previous fold trained on rows that are in the current fold's test set
+MLP_WARM_START = False
+MLP_MAX_ITER = 1000
+MLP_N_ITER_NO_CHANGE = 10
+MLP_BATCHES_PER_EPOCH = 20
 
 if os.name == 'nt':
     HOME_DIRECTORY = os.path.join('C:\\', 'Users', 'atm15.CSENETID', 'Desktop', 'beat-pd')
@@ -24,6 +47,20 @@ else:
     HOME_DIRECTORY = os.path.join('/Users', 'alex', 'Desktop', 'beat-pd')
     RUN_PARALLEL = False
 
+# Split the thread budget between workers, pinning BLAS/OpenMP pools of processes started from here
+NUM_WORKERS = max(1, min(NUM_THREADS, THREAD_BUDGET)) if RUN_PARALLEL else 1
+THREADS_PER_WORKER = max(1, THREAD_BUDGET // NUM_WORKERS)
+os.environ.update({variable: str(THREADS_PER_WORKER) for variable in
+                   ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']})
+
+# Distributed parameters, where workers on any host pull subject/fold tasks from a queue in the run folder
+RUN_DISTRIBUTED = False
+TASK_LEASE_SECONDS = 300  # Tasks of workers without a heartbeat for this long are retried
+TASK_HEARTBEAT_SECONDS = 30
+TASK_MAX_ATTEMPTS = 3
+TASK_POLL_SECONDS = 10
+TASK_IDLE_EXIT_SECONDS = 3600  # Workers that only find drained queues exit after idling this long
+
 # Classifiers
 CLASSIF_RANDOM_FOREST = 'classif-rf'
 CLASSIF_XGBOOST = 'classif-xg'
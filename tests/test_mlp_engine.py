@@ -0,0 +1,29 @@
+import pytest
+
+# The MLP engine pulls in settings and sklearn, so skip where the training dependencies are not installed
+pytest.importorskip('sklearn')
+
+from model_training.mlp_engine import FastMLPClassifier, mlp_params
+import numpy as np
+
+
+def fit_classifier(y):
+    x = np.random.RandomState(0).normal(size=(len(y), 5))
+    model = FastMLPClassifier(hidden_layer_sizes=(4,), **mlp_params(len(y)))
+    return model.fit(x, y)
+
+
+def test_fits_small_data():
+    y = np.repeat([0, 1, 2], 20)
+    model = fit_classifier(y)
+    assert list(model.classes_) == [0, 1, 2]
+    assert model.n_iter_ >= 1
+    assert model.fit_time_ >= 0
+
+
+def test_fits_tiny_imbalanced_data():
+    # A single example of a class cannot be stratified into a validation split, so early stopping is skipped
+    y = np.array([0] * 7 + [1])
+    model = fit_classifier(y)
+    assert list(model.classes_) == [0, 1]
+    assert model.early_stopping == mlp_params(len(y)).get('early_stopping', False)
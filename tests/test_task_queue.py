@@ -0,0 +1,66 @@
+from model_training.task_queue import TaskQueue, TASK_DONE, TASK_FAILED, TASK_PENDING, TASK_RUNNING
+import time
+
+
+def make_queue(tmp_path, lease_seconds=60, max_attempts=3):
+    return TaskQueue(str(tmp_path / 'tasks.db'), lease_seconds, max_attempts)
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=1)
+    queue.publish([('task', {'fold_idx': 0})])
+    task_id, task = queue.claim('worker-1')
+    assert task == {'fold_idx': 0}
+
+    # The lease is still held, so nothing else can be claimed
+    assert queue.claim('worker-2') == (None, None)
+    assert queue.counts()[TASK_RUNNING] == 1
+
+    # Without heartbeats the lease expires and the task goes to the next worker
+    time.sleep(1.5)
+    queue.requeue_expired()
+    assert queue.counts()[TASK_PENDING] == 1
+    assert queue.claim('worker-2')[0] == task_id
+    assert queue.counts()[TASK_RUNNING] == 1
+
+
+def test_fail_retries_up_to_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=3)
+    queue.publish([('task', {'fold_idx': 0})])
+    for attempt in range(3):
+        task_id, _ = queue.claim('worker-1')
+        assert task_id is not None
+        queue.fail(task_id, 'worker-1', 'error %d' % attempt)
+
+    # The last attempt fails the task for good
+    assert queue.claim('worker-1') == (None, None)
+    assert queue.counts()[TASK_FAILED] == 1
+    assert queue.results() == [('task', TASK_FAILED, None, 'error 2')]
+
+    # Publishing it again gives it a fresh set of attempts
+    queue.publish([('task', {'fold_idx': 0})])
+    assert queue.counts()[TASK_PENDING] == 1
+    assert queue.claim('worker-1')[0] == task_id
+
+
+def test_stale_worker_cannot_complete(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=1)
+    queue.publish([('task', {'fold_idx': 0})])
+    task_id, _ = queue.claim('worker-1')
+    time.sleep(1.5)
+    assert queue.claim('worker-2')[0] == task_id
+
+    # The first worker's late result is dropped while the new holder's is kept
+    queue.complete(task_id, 'worker-1', 'stale')
+    assert queue.counts()[TASK_RUNNING] == 1
+    queue.complete(task_id, 'worker-2', 'fresh')
+    assert queue.results() == [('task', TASK_DONE, 'fresh', None)]
+
+
+def test_publish_opens_generation(tmp_path):
+    queue = make_queue(tmp_path)
+    assert queue.generation() == (0, True)
+    queue.publish([('task', {'fold_idx': 0})])
+    assert queue.generation() == (1, False)
+    queue.mark_drained()
+    assert queue.generation() == (1, True)
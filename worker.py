@@ -0,0 +1,8 @@
+from model_training.distributed import run_worker
+from model_training.helpers import limit_threads
+import sys
+
+# Pull training tasks for a distributed run until its queue is drained, e.g. `python worker.py <run id>`
+run_id = sys.argv[1] if len(sys.argv) > 1 else input('Run id: ')
+limit_threads()
+run_worker(run_id)